@@ -1,50 +1,65 @@
-import joblib
-from app.knowledge import get_historical_data, get_thresholds, get_ml_model
-from app.ml_model import predict_anomalies
+import numpy as np
+from app.knowledge import get_ml_model, threshold_label
 from app.logger import get_logger
-from app.knowledge import update_anomaly_label
 
 logger = get_logger()
 
-def analyze(data):
-    print("Analyzing data:",data)
-    node_id = data.node_id
-    thresholds = get_thresholds(node_id)
-    logger.info(f"Analyzing data: {data}")
-
-    # Retrieve historical data for the node
-    historical_data = get_historical_data(node_id)
-    logger.info(f"Historical data for node {node_id}: {historical_data}")
-
+def predict_batch(node_id, batch):
+    # One predict() call for every sample of the node; None if no model is usable
     try:
         model = get_ml_model(node_id)
         if model:
             # Prepare the data for prediction
-            input_features = [[data.temperature, data.humidity]]
-            prediction = model.predict(input_features)
-            if prediction == 1:  # Assuming 1 indicates an anomaly
-                logger.info(f"Anomaly detected for node {node_id}")
-                return {
-                    "node_id": node_id,
-                    "status": "anomaly",
-                    "details": data
-                }
+            input_features = np.array([[data.temperature, data.humidity] for data in batch], dtype=np.float32)
+            return model.predict(input_features)
         else:
-            logger.warning(f"No model found for node_id: {node_id}")
+            logger.warning("No model found for node_id: %s", node_id)
 
     except Exception as e:
-        logger.error(f"Error loading or using model for node {node_id}: {e}")
+        logger.error("Error loading or using model for node %s: %s", node_id, e)
+
+    return None
+
+def analyze_node(node_id, batch, labels):
+    # labels are the threshold labels monitor stored with each sample, reused so
+    # the alert always agrees with the stored row
+    predictions = predict_batch(node_id, batch)
 
+    results = []
+    for i, data in enumerate(batch):
+        logger.info("Analyzing data: %s", data)
 
-    latest_data = historical_data[0] if historical_data else None
-    
-    # Check against thresholds if model-based detection didn't find an anomaly
-    if thresholds:
-        temp_threshold, humidity_threshold = thresholds
-        if data.temperature > temp_threshold or data.humidity > humidity_threshold:
-            update_anomaly_label(node_id, latest_data[0], 1)
-            return {"node_id": node_id, "status": "anomaly", "reason": "threshold", "data": data, "historical_data": historical_data}
+        if predictions is not None and predictions[i] == 1:  # Assuming 1 indicates an anomaly
+            logger.info("Anomaly detected for node %s", node_id)
+            results.append({
+                "node_id": node_id,
+                "status": "anomaly",
+                "details": data
+            })
+            continue
 
-    # If neither thresholds nor model-based detection found anomalies, return normal status
-    return {"status": "normal","data": data,"historical_data": historical_data}
+        # Check against thresholds if model-based detection didn't find an anomaly
+        if labels[i]:
+            results.append({"node_id": node_id, "status": "anomaly", "reason": "threshold", "data": data})
+            continue
 
+        # If neither thresholds nor model-based detection found anomalies, return normal status
+        results.append({"status": "normal","data": data})
+
+    return results
+
+def analyze_batch(batch, labels):
+    # Group samples by node so each node's model runs once over its samples
+    groups = {}
+    for i, data in enumerate(batch):
+        groups.setdefault(data.node_id, []).append(i)
+
+    results = [None] * len(batch)
+    for node_id, indices in groups.items():
+        node_results = analyze_node(node_id, [batch[i] for i in indices], [labels[i] for i in indices])
+        for i, result in zip(indices, node_results):
+            results[i] = result
+    return results
+
+def analyze(data):
+    return analyze_batch([data], [threshold_label(data)])[0]
@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from app.analyze import analyze_batch
+from app.logger import get_logger
+
+logger = get_logger()
+
+# A batch is cut at MAX_BATCH samples or MAX_WAIT seconds after its first sample
+MAX_BATCH = 64
+MAX_WAIT = 0.005
+
+_queue = None
+_task = None
+# Batches run one at a time, so one warm thread serves them all
+_executor = None
+
+async def _collect(loop):
+    batch = [await _queue.get()]
+    deadline = loop.time() + MAX_WAIT
+    while len(batch) < MAX_BATCH:
+        if _queue.empty():
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        else:
+            batch.append(_queue.get_nowait())
+    return batch
+
+async def _run():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await _collect(loop)
+        try:
+            # Prediction is blocking, keep it off the event loop
+            results = await loop.run_in_executor(
+                _executor, analyze_batch, [data for data, _, _ in batch], [label for _, label, _ in batch]
+            )
+        except Exception as e:
+            logger.error("Error analyzing batch of %d samples: %s", len(batch), e)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+def start_batcher():
+    global _queue, _task, _executor
+    _queue = asyncio.Queue()
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analyzer')
+    _task = asyncio.create_task(_run())
+
+async def stop_batcher():
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+    if _executor:
+        _executor.shutdown()
+
+async def submit(data, anomaly_label):
+    # anomaly_label is the threshold label monitor stored for data. Resolves to
+    # the same result analyze(data) would return.
+    future = asyncio.get_running_loop().create_future()
+    _queue.put_nowait((data, anomaly_label, future))
+    return await future
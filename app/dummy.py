@@ -1,17 +1,18 @@
-import joblib
 import os
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import RandomForestClassifier
 
 def train_dummy_model():
+    import numpy as np
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.ensemble import RandomForestClassifier
+
     # Dummy training data
-    X = [[0, 0], [1, 1]]
+    X = np.asarray([[0, 0], [1, 1]], dtype=np.float32)
     y = [0, 1]
     
     pipeline = Pipeline([
         ('scaler', StandardScaler()),
-        ('classifier', RandomForestClassifier(random_state=42))
+        ('classifier', RandomForestClassifier(n_estimators=16, max_depth=6, random_state=42))
     ])
     
     pipeline.fit(X, y)
@@ -19,11 +20,15 @@ def train_dummy_model():
     return pipeline
 
 def store_ml_model(node_id, model):
+    import joblib
+
     model_filename = f"../ml-models/{node_id}_model.pkl"
     joblib.dump(model, model_filename)
     print(f"Model stored successfully for node_id {node_id} at {model_filename}")
 
 def load_ml_model(node_id):
+    import joblib
+
     model_filename = f"../ml-models/{node_id}_model.pkl"
     if os.path.exists(model_filename):
         file_size = os.path.getsize(model_filename)
@@ -40,13 +45,14 @@ def load_ml_model(node_id):
         print(f"No model found for node_id {node_id}")
         return None
 
-# Test the save and load functionality
-node_id = "test_node"
-dummy_model = train_dummy_model()
-store_ml_model(node_id, dummy_model)
+if __name__ == "__main__":
+    # Test the save and load functionality
+    node_id = "test_node"
+    dummy_model = train_dummy_model()
+    store_ml_model(node_id, dummy_model)
 
-loaded_model = load_ml_model(node_id)
-if loaded_model:
-    print(f"Model loaded successfully: {type(loaded_model)}")
-else:
-    print("Failed to load model")
+    loaded_model = load_ml_model(node_id)
+    if loaded_model:
+        print(f"Model loaded successfully: {type(loaded_model)}")
+    else:
+        print("Failed to load model")
@@ -3,9 +3,9 @@ from app.logger import get_logger
 logger = get_logger()
 
 def execute(plan_result):
-    logger.info(f"Executing plan: {plan_result}")
+    logger.info("Executing plan: %s", plan_result)
     if plan_result["action"] == "alert":
         # Example: Execute an alert action
-        logger.warning(f"Alert! Anomaly detected: {plan_result['details']}")
+        logger.warning("Alert! Anomaly detected: %s", plan_result['details'])
     else:
         logger.info("No action needed.")
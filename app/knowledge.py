@@ -1,144 +1,393 @@
+import atexit
+import os
+import queue
 import sqlite3
+import threading
+import time
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
 from app.logger import get_logger
+from app.ml_model import OnnxModel, to_onnx
 import joblib
 
 logger = get_logger()
 
-# Initialize the database
-conn = sqlite3.connect('knowledge_base.db')
-c = conn.cursor()
+SQL_INSERT_IOT = '''
+INSERT INTO iot_data (node_id, temperature, humidity, anomaly_label)
+VALUES (?, ?, ?, ?)
+'''
+
+SQL_GET_HIST = '''
+SELECT id,temperature, humidity, timestamp_iso, anomaly_label FROM iot_data_iso
+WHERE node_id = ?
+ORDER BY id DESC
+LIMIT 100
+'''
+
+SQL_GET_LATEST = '''
+SELECT id,temperature, humidity, timestamp_iso, anomaly_label FROM iot_data_iso
+WHERE node_id = ?
+ORDER BY id DESC
+LIMIT 1
+'''
+
+SQL_GET_HIST_COLUMNS = '''
+SELECT id, temperature, humidity, anomaly_label FROM iot_data
+WHERE node_id = ?
+ORDER BY id DESC
+LIMIT 100
+'''
+
+SQL_GET_ALL_THRESH = '''
+SELECT node_id, temperature_threshold, humidity_threshold FROM thresholds
+'''
+
+SQL_SET_THRESH = '''
+INSERT OR REPLACE INTO thresholds (node_id, temperature_threshold, humidity_threshold)
+VALUES (?, ?, ?)
+'''
+
+# Walks the distinct node_ids through idx_iot_node_id, one index seek per node
+# instead of a scan over every row
+SQL_GET_NODE_IDS = '''
+WITH RECURSIVE nodes(node_id) AS (
+    SELECT MIN(node_id) FROM iot_data
+    UNION ALL
+    SELECT (SELECT MIN(node_id) FROM iot_data WHERE node_id > nodes.node_id)
+    FROM nodes WHERE node_id IS NOT NULL
+)
+SELECT node_id FROM nodes WHERE node_id IS NOT NULL
+'''
 
-# Create tables
-c.execute('''
-CREATE TABLE IF NOT EXISTS iot_data (
+# Write-behind batching: at most this many rows, or this many seconds of
+# waiting, per committed transaction
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_INTERVAL = 0.1
+
+# Thresholds set through another worker process reach this one within this
+# many seconds, see _refresh_thresholds
+THRESHOLDS_REFRESH_INTERVAL = 1.0
+
+def _connect():
+    # The statement cache keeps the compiled form of the SQL constants above,
+    # so the hot path never re-parses them. isolation_level=None leaves
+    # transactions to the write-behind thread, every other statement autocommits.
+    connection = sqlite3.connect('knowledge_base.db', check_same_thread=False, isolation_level=None, cached_statements=256)
+    # WAL lets the per-thread readers run alongside the writer, and with
+    # synchronous=NORMAL avoids an fsync per committed insert
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA temp_store=MEMORY')
+    connection.execute('PRAGMA cache_size=-20000')
+    return connection
+
+# One connection and cursor per thread, FastAPI runs handlers on a thread pool
+_local = threading.local()
+
+def _local_cursor():
+    cur = getattr(_local, 'cursor', None)
+    if cur is None:
+        cur = _local.cursor = _connect().cursor()
+    return cur
+
+# Timestamps are stored as integer epoch seconds, which keep the timestamp index
+# small and compare as integers. strftime rather than unixepoch() keeps SQLite
+# versions before 3.38 working.
+IOT_DATA_COLUMNS = '''
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     node_id TEXT NOT NULL,
     temperature REAL NOT NULL,
     humidity REAL NOT NULL,
     anomaly_label INTEGER DEFAULT 0,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-''')
+    timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+'''
 
-c.execute('''
-CREATE TABLE IF NOT EXISTS thresholds (
-    node_id TEXT PRIMARY KEY,
-    temperature_threshold REAL NOT NULL,
-    humidity_threshold REAL NOT NULL
-)
-''')
+# Bumped whenever _create_schema changes, recorded in PRAGMA user_version
+SCHEMA_VERSION = 2
 
-c.execute('''
-CREATE TABLE IF NOT EXISTS ml_models (
-    node_id TEXT PRIMARY KEY,
-    model BLOB NOT NULL
-)
-''')
+def _timestamp_type(cur):
+    return {row[1]: row[2] for row in cur.execute('PRAGMA table_info(iot_data)')}['timestamp']
+
+def _migrate_timestamps(cur):
+    # Rewrites a table created with the old DATETIME text column in place
+    cur.execute('BEGIN IMMEDIATE')
+    if _timestamp_type(cur) == 'INTEGER':
+        # Another process migrated it while we were starting up
+        cur.execute('COMMIT')
+        return
+    cur.execute(f'CREATE TABLE iot_data_new ({IOT_DATA_COLUMNS})')
+    cur.execute('''
+    INSERT INTO iot_data_new (id, node_id, temperature, humidity, anomaly_label, timestamp)
+    SELECT id, node_id, temperature, humidity, anomaly_label,
+           COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER))
+    FROM iot_data
+    ''')
+    cur.execute('DROP TABLE iot_data')
+    cur.execute('ALTER TABLE iot_data_new RENAME TO iot_data')
+    cur.execute('COMMIT')
+    logger.info("Migrated iot_data timestamps to epoch seconds")
+
+def _create_schema(cur):
+    # Every API worker and retraining process runs this at import; once the
+    # database is current that is a single PRAGMA read
+    if cur.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+        return
+
+    cur.execute(f'CREATE TABLE IF NOT EXISTS iot_data ({IOT_DATA_COLUMNS})')
+
+    if _timestamp_type(cur) != 'INTEGER':
+        _migrate_timestamps(cur)
+
+    # The API keeps serving timestamps in the old ISO text form
+    cur.execute('''
+    CREATE VIEW IF NOT EXISTS iot_data_iso AS
+    SELECT id, node_id, temperature, humidity, anomaly_label,
+           datetime(timestamp, 'unixepoch') AS timestamp_iso
+    FROM iot_data
+    ''')
+
+    # Every read orders a node's rows by id, so this index serves the history,
+    # latest-sample and node-id queries straight from the index without a sort
+    cur.execute('''
+    CREATE INDEX IF NOT EXISTS idx_iot_node_id ON iot_data(node_id, id DESC)
+    ''')
+
+    # No query orders by timestamp, so this index only slowed down inserts
+    cur.execute('DROP INDEX IF EXISTS idx_iot_node_ts')
+
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS thresholds (
+        node_id TEXT PRIMARY KEY,
+        temperature_threshold REAL NOT NULL,
+        humidity_threshold REAL NOT NULL
+    )
+    ''')
+
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS ml_models (
+        node_id TEXT PRIMARY KEY,
+        model BLOB NOT NULL
+    )
+    ''')
 
-conn.commit()
+    cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+# Initialize the database
+_create_schema(_local_cursor())
+
+# Pending writes as (sql, params) in arrival order; a (None, Event) entry marks a flush
+_write_queue = queue.SimpleQueue()
+
+def _apply_writes(cur, batch):
+    writes = [op for op in batch if op[0] is not None]
+    try:
+        try:
+            cur.execute('BEGIN')
+            # Consecutive statements of the same kind go out as one executemany
+            for sql, ops in groupby(writes, key=itemgetter(0)):
+                cur.executemany(sql, [params for _, params in ops])
+            cur.execute('COMMIT')
+        except sqlite3.Error as e:
+            if cur.connection.in_transaction:
+                cur.execute('ROLLBACK')
+            logger.error("Error writing %d queued rows to knowledge base, retrying one by one: %s", len(writes), e)
+            # Autocommit each write so a single bad row does not drop the whole batch
+            for sql, params in writes:
+                try:
+                    cur.execute(sql, params)
+                except sqlite3.Error as e:
+                    logger.error("Error writing queued row %s to knowledge base: %s", params, e)
+    finally:
+        # Release flush() callers even if the batch failed, or they wait forever
+        for op in batch:
+            if op[0] is None:
+                op[1].set()
+
+def _write_behind():
+    cur = _local_cursor()
+    while True:
+        batch = [_write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_INTERVAL
+        while batch[-1][0] is not None and len(batch) < WRITE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            _apply_writes(cur, batch)
+        except Exception:
+            # Keep the thread alive, every later write depends on it
+            logger.exception("Error applying %d queued writes to knowledge base", len(batch))
+
+def flush():
+    # Blocks until every write queued so far is committed
+    done = threading.Event()
+    _write_queue.put((None, done))
+    done.wait()
+
+threading.Thread(target=_write_behind, name='knowledge-writer', daemon=True).start()
+atexit.register(flush)
 
 def update_knowledge(data):
-    with conn:
-        c.execute('''
-        INSERT INTO iot_data (node_id, temperature, humidity) 
-        VALUES (?, ?, ?)
-        ''', (data.node_id, data.temperature, data.humidity))
-    logger.info(f"Data inserted into knowledge base: {data}")
+    # The threshold label is written with the row itself, so it always lands on
+    # the right sample however many readings of the node are in flight. It is
+    # returned so analysis reports the same verdict that was stored.
+    anomaly_label = threshold_label(data)
+    _write_queue.put((SQL_INSERT_IOT, (data.node_id, data.temperature, data.humidity, anomaly_label)))
+    logger.info("Data queued for knowledge base: %s", data)
+    return anomaly_label
     
-def update_anomaly_label(node_id, data_id, anomaly_label):
-    with conn:
-        c.execute('''
-        UPDATE iot_data
-        SET anomaly_label = ?
-        WHERE id = ?
-        AND node_id = ?
-        ''', (anomaly_label, data_id, node_id))
-    logger.info(f"Anomaly label updated for node {node_id} with id {data_id}: {anomaly_label}")
-
 
 def get_historical_data(node_id):
-    c.execute('''
-    SELECT id,temperature, humidity, timestamp, anomaly_label FROM iot_data
-    WHERE node_id = ?
-    ORDER BY timestamp DESC
-    LIMIT 100
-    ''', (node_id,))
-    return c.fetchall()
+    cur = _local_cursor()
+    cur.execute(SQL_GET_HIST, (node_id,))
+    return cur.fetchall()
+
+def get_latest_sample(node_id):
+    cur = _local_cursor()
+    cur.execute(SQL_GET_LATEST, (node_id,))
+    return cur.fetchone()
+
+def get_historical_columns(node_id):
+    # Same rows as get_historical_data, split once into one numpy array per
+    # column for vectorized consumers such as training. Readings stay float64,
+    # the stored precision, so threshold comparisons on them are exact.
+    cur = _local_cursor()
+    cur.execute(SQL_GET_HIST_COLUMNS, (node_id,))
+    rows = cur.fetchall()
+    ids, temperatures, humidities, labels = zip(*rows) if rows else ((),) * 4
+    return {
+        'id': np.fromiter(ids, dtype=np.int64, count=len(rows)),
+        'temperature': np.fromiter(temperatures, dtype=np.float64, count=len(rows)),
+        'humidity': np.fromiter(humidities, dtype=np.float64, count=len(rows)),
+        'anomaly_label': np.fromiter(labels, dtype=np.int8, count=len(rows)),
+    }
+
+def _load_thresholds():
+    return {
+        node_id: (temperature_threshold, humidity_threshold)
+        for node_id, temperature_threshold, humidity_threshold in _local_cursor().execute(SQL_GET_ALL_THRESH)
+    }
+
+# Every node's thresholds, kept in step by set_thresholds and re-read by a
+# background thread, so the request path only ever reads this dict
+_thresholds_lock = threading.Lock()
+_THRESHOLDS: dict[str, tuple[float, float]] = _load_thresholds()
+
+def _refresh_thresholds():
+    global _THRESHOLDS
+    while True:
+        time.sleep(THRESHOLDS_REFRESH_INTERVAL)
+        try:
+            # Load and swap under the lock, so a concurrent set_thresholds is
+            # never overwritten by a table read taken before its INSERT
+            with _thresholds_lock:
+                _THRESHOLDS = _load_thresholds()
+        except Exception:
+            logger.exception("Error refreshing thresholds from knowledge base")
+
+threading.Thread(target=_refresh_thresholds, name='thresholds-refresh', daemon=True).start()
 
 def get_thresholds(node_id):
-    c.execute('''
-    SELECT temperature_threshold, humidity_threshold FROM thresholds
-    WHERE node_id = ?
-    ''', (node_id,))
-    return c.fetchone()
+    return _THRESHOLDS.get(node_id)
+
+def threshold_label(data):
+    # 1 if the reading exceeds its node's thresholds, the one place this is checked
+    thresholds = get_thresholds(data.node_id)
+    if thresholds:
+        temp_threshold, humidity_threshold = thresholds
+        if data.temperature > temp_threshold or data.humidity > humidity_threshold:
+            return 1
+    return 0
 
 def get_node_ids():
-    c.execute('''
-    SELECT DISTINCT node_id FROM iot_data
-    ''')
-    return c.fetchall()
+    # Read from the table every time, so nodes that reported to another worker
+    # are listed and retrained too
+    cur = _local_cursor()
+    cur.execute(SQL_GET_NODE_IDS)
+    return cur.fetchall()
 
 def set_thresholds(node_id, temperature_threshold, humidity_threshold):
-    with conn:
-        c.execute('''
-        INSERT OR REPLACE INTO thresholds (node_id, temperature_threshold, humidity_threshold)
-        VALUES (?, ?, ?)
-        ''', (node_id, temperature_threshold, humidity_threshold))
-    logger.info(f"Thresholds set for node {node_id}: Temperature - {temperature_threshold}, Humidity - {humidity_threshold}")
-
-def get_thresholds(node_id):
-    c.execute('''
-    SELECT temperature_threshold, humidity_threshold FROM thresholds
-    WHERE node_id = ?
-    ''', (node_id,))
-    return c.fetchone()
-
-# def store_ml_model(node_id, model):
-#     c.execute('''
-#     INSERT OR REPLACE INTO ml_models (node_id, model)
-#     VALUES (?, ?)
-#     ''', (node_id, model))
-#     conn.commit()
-    
-# def get_ml_model(node_id):
-#     c.execute('''
-#     SELECT model FROM ml_models
-#     WHERE node_id = ?
-#     ''', (node_id,))
-#     model_blob = c.fetchone()
-
-#     if model_blob:
-#         try:
-#             # Deserialize the model from the stored bytes object using joblib.load
-#             model = joblib.load(model_blob[0])
-#             return model
-#         except Exception as e:
-#             logger.error(f"Error loading model for node {node_id}: {e}")
-#             return None
-#     else:
-#         logger.warning(f"No model found for node_id: {node_id}")
-#         return None
+    # The INSERT can wait on the write-behind transaction, so it runs outside
+    # the lock and only the dict update is guarded
+    _local_cursor().execute(SQL_SET_THRESH, (node_id, temperature_threshold, humidity_threshold))
+    with _thresholds_lock:
+        _THRESHOLDS[node_id] = (float(temperature_threshold), float(humidity_threshold))
+    logger.info("Thresholds set for node %s: Temperature - %s, Humidity - %s", node_id, temperature_threshold, humidity_threshold)
 
 def store_ml_model(node_id, model):
     model_filename = f"ml-models/{node_id}_model.pkl"
     joblib.dump(model, model_filename)
-    
+    # The ONNX copy is what get_ml_model serves; the pickle stays as the fallback
+    onnx_filename = f"ml-models/{node_id}_model.onnx"
+    try:
+        onnx_bytes = to_onnx(model)
+    except Exception as e:
+        logger.error("Error converting model for node %s to ONNX: %s", node_id, e)
+        if os.path.exists(onnx_filename):
+            os.remove(onnx_filename)
+        return
+    # Write then rename so a concurrent get_ml_model never sees a partial file
+    with open(onnx_filename + '.tmp', 'wb') as f:
+        f.write(onnx_bytes)
+    os.replace(onnx_filename + '.tmp', onnx_filename)
+
+# Loaded models keyed by file path, as (st_mtime_ns, model). A rewrite of the
+# file by retraining changes the mtime and forces a reload.
+_model_cache: dict[str, tuple[int, object]] = {}
+_model_cache_lock = threading.Lock()
+
+def _load_model(model_filename):
+    mtime = os.stat(model_filename).st_mtime_ns
+    with _model_cache_lock:
+        cached = _model_cache.get(model_filename)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        if model_filename.endswith('.onnx'):
+            model = OnnxModel(model_filename)
+        else:
+            model = joblib.load(model_filename)
+        _model_cache[model_filename] = (mtime, model)
+    return model
+
 def get_ml_model(node_id):
+    onnx_filename = f"ml-models/{node_id}_model.onnx"
     model_filename = f"ml-models/{node_id}_model.pkl"
     try:
-        model = joblib.load(model_filename)
-        return model
+        if os.path.exists(onnx_filename):
+            return _load_model(onnx_filename)
+        return _load_model(model_filename)
     except FileNotFoundError:
-        logger.warning(f"No model found for node_id: {node_id}")
+        logger.warning("No model found for node_id: %s", node_id)
         return None
     except Exception as e:
-        logger.error(f"Error loading model for node {node_id}: {e}")
+        logger.error("Error loading model for node %s: %s", node_id, e)
         return None
 
+def warm_model_cache():
+    # Load every stored model once and run a throwaway prediction, so lazy
+    # imports and session setup happen before the first real request
+    try:
+        filenames = os.listdir('ml-models')
+    except FileNotFoundError:
+        # Nothing has been trained yet
+        return
+    node_ids = {
+        filename.rsplit('_model.', 1)[0]
+        for filename in filenames
+        if filename.endswith(('_model.pkl', '_model.onnx'))
+    }
+    for node_id in node_ids:
+        model = get_ml_model(node_id)
+        if model:
+            try:
+                model.predict(np.zeros((1, 2), dtype=np.float32))
+            except Exception as e:
+                logger.error("Error warming model for node %s: %s", node_id, e)
+
 def get_all_node_ids():
-    conn = sqlite3.connect('knowledge.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT node_id FROM historical_data")
-    node_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return node_ids
+    return [row[0] for row in get_node_ids()]
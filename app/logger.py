@@ -1,9 +1,22 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Records are written to the file by a listener thread, so request handlers
+# and the analysis thread never block on log file I/O
+_file_handler = logging.FileHandler('logs/mape_k_system.log')
+_file_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+_log_queue = queue.SimpleQueue()
+_listener = QueueListener(_log_queue, _file_handler)
+_listener.start()
+atexit.register(_listener.stop)
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 
 logging.basicConfig(
-    filename='logs/mape_k_system.log',
     level=logging.INFO,
-    format='%(asctime)s:%(levelname)s:%(message)s'
+    handlers=[_queue_handler]
 )
 
 def get_logger():
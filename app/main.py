@@ -1,21 +1,47 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import re
+import msgspec
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel
 from apscheduler.schedulers.background import BackgroundScheduler
 from app.monitor import monitor
-from app.analyze import analyze
+from app.batcher import start_batcher, stop_batcher, submit
 from app.plan import plan
 from app.execute import execute
-from app.knowledge import set_thresholds, store_ml_model, get_historical_data, update_knowledge, get_all_node_ids, get_thresholds,get_node_ids
+from app.knowledge import set_thresholds, store_ml_model, get_historical_data, get_historical_columns, get_latest_sample, update_knowledge, get_thresholds,get_node_ids, flush, warm_model_cache
 from app.ml_model import train_ml_model
-import pickle
+from app.retrain import retrain_all_nodes
 
 app = FastAPI()
 scheduler = BackgroundScheduler()
 
-class IoTNodeData(BaseModel):
+# Decoded by msgspec straight from the request body, this endpoint is the hot path.
+# Only scalar fields, so instances can skip GC tracking
+class IoTNodeData(msgspec.Struct, gc=False):
     node_id: str
     temperature: float
     humidity: float
+
+# The body is not a FastAPI parameter, so describe it to OpenAPI by hand
+IOT_DATA_REQUEST_BODY = {
+    "required": True,
+    "content": {"application/json": {"schema": msgspec.json.schema_components([IoTNodeData])[1]['IoTNodeData']}},
+}
+
+def _validation_errors(e):
+    # msgspec reports one error as "<message> - at `$.path`"; reshape it into the
+    # list FastAPI returns when pydantic rejects a body
+    msg, _, path = str(e).partition(' - at `')
+    loc = ['body'] + [int(part) if part.isdigit() else part for part in re.findall(r'[^$.\[\]`]+', path)]
+    if not isinstance(e, msgspec.ValidationError):
+        error_type = 'json_invalid'
+    elif msg.startswith('Object missing required field'):
+        error_type = 'missing'
+        loc.append(msg.rsplit('`', 2)[1])
+    else:
+        error_type = 'value_error'
+    return [{'type': error_type, 'loc': loc, 'msg': msg}]
     
     
 class Thresholds(BaseModel):
@@ -23,19 +49,32 @@ class Thresholds(BaseModel):
     temperature_threshold: float
     humidity_threshold: float
 
-@app.post("/iot/data")
-async def receive_data(data: IoTNodeData):
+# Response shapes; with a return annotation FastAPI serializes the response
+# through pydantic's compiled serializer instead of jsonable_encoder
+Status = dict[str, str]
+# (id, temperature, humidity, timestamp, anomaly_label), as stored
+IoTDataRow = tuple[int, float, float, str, int]
+
+@app.post("/iot/data", openapi_extra={"requestBody": IOT_DATA_REQUEST_BODY})
+async def receive_data(request: Request) -> Status:
+    try:
+        # strict=False accepts numeric strings like "25.5", as pydantic did
+        data = msgspec.json.decode(await request.body(), type=IoTNodeData, strict=False)
+    except msgspec.DecodeError as e:
+        raise RequestValidationError(_validation_errors(e))
     try:
-        monitor(data)
-        analysis_result = analyze(data)
+        anomaly_label = monitor(data)
+        analysis_result = await submit(data, anomaly_label)
         plan_result = plan(analysis_result)
         execute(plan_result)
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Handlers that block on SQLite or training are plain functions, which FastAPI
+# runs in its thread pool instead of on the event loop
 @app.post("/iot/thresholds")
-async def set_node_thresholds(thresholds: Thresholds):
+def set_node_thresholds(thresholds: Thresholds) -> Status:
     try:
         set_thresholds(thresholds.node_id, thresholds.temperature_threshold, thresholds.humidity_threshold)
         return {"status": "success"}
@@ -43,21 +82,20 @@ async def set_node_thresholds(thresholds: Thresholds):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/iot/train_model/{node_id}")
-async def train_node_model(node_id: str):
+def train_node_model(node_id: str) -> Status:
     try:
-        historical_data = get_historical_data(node_id)
-        if not historical_data:
+        historical_data = get_historical_columns(node_id)
+        if not len(historical_data['id']):
             raise HTTPException(status_code=404, detail="No historical data found for the specified node_id")
         
-        model = train_ml_model(historical_data)
-        model_blob = pickle.dumps(model)  # Serialize the model
-        store_ml_model(node_id, model_blob)  # Store the serialized model
+        model = train_ml_model(historical_data, get_thresholds(node_id))
+        store_ml_model(node_id, model)  # Store the fitted estimator, get_ml_model caches it
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/get_data/{node_id}")
-async def get_data(node_id: str):
+def get_data(node_id: str) -> list[IoTDataRow]:
     try:
         historical_data = get_historical_data(node_id)
         return historical_data
@@ -65,18 +103,14 @@ async def get_data(node_id: str):
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/get_latest_data/{node_id}")
-async def get_latest_data(node_id: str):
+def get_latest_data(node_id: str) -> IoTDataRow | None:
     try:
-        historical_data = get_historical_data(node_id)
-        if historical_data:
-            return historical_data[0]
-        else:
-            return None
+        return get_latest_sample(node_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/get_all_node_ids")
-async def get_all_node_ids():
+def get_all_node_ids() -> list[tuple[str]]:
     try:
         node_ids = get_node_ids()
         return node_ids
@@ -84,7 +118,7 @@ async def get_all_node_ids():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/get_thresholds/{node_id}")
-async def get_thresholds_values(node_id: str):
+async def get_thresholds_values(node_id: str) -> tuple[float, float] | None:
     try:
         thresholds = get_thresholds(node_id)
         return thresholds
@@ -92,21 +126,21 @@ async def get_thresholds_values(node_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 def scheduled_retraining():
-    node_ids = get_all_node_ids()
-    for node_id in node_ids:
-        try:
-            historical_data = get_historical_data(node_id)
-            if historical_data:
-                model_blob = train_ml_model(historical_data)
-                store_ml_model(node_id, model_blob)
-                print(f"Model retrained for node {node_id}")
-        except Exception as e:
-            print(f"Error retraining model for node {node_id}: {str(e)}")
+    # Trains in worker processes so the API process keeps its CPU and GIL
+    retrain_all_nodes()
 
 # Schedule the retraining every day at midnight
 scheduler.add_job(scheduled_retraining, 'cron', hour=0, minute=0)
 scheduler.start()
 
+@app.on_event("startup")
+async def startup_event():
+    # Model loading and ONNX session setup block, keep them off the event loop
+    await asyncio.to_thread(warm_model_cache)
+    start_batcher()
+
 @app.on_event("shutdown")
-def shutdown_event():
+async def shutdown_event():
+    await stop_batcher()
     scheduler.shutdown()
+    flush()
@@ -1,33 +1,50 @@
-import pickle
-from typing import List, Dict
-import pandas as pd
+import numpy as np
+import onnxruntime
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
 from sklearn.ensemble import RandomForestClassifier
-from pydantic import BaseModel
-from app.knowledge import store_ml_model
+from app.logger import get_logger
 
+logger = get_logger()
 
-class IoTNodeData(BaseModel):
-    id: int
-    node_id: str
-    temperature: float
-    humidity: float
-    anomaly_label: int
+def train_ml_model(historical_data, thresholds=None, n_jobs=1):
+    # historical_data holds one array per column, see get_historical_columns
+    temps = historical_data['temperature']
+    hums = historical_data['humidity']
 
-def train_ml_model(historical_data):
-    # Convert the historical data into a DataFrame for easier manipulation
-    columns = ['id', 'temperature', 'humidity', 'timestamp', 'anomaly_label']
-    df = pd.DataFrame(historical_data, columns=columns)
-    
     # Prepare the feature matrix (X) and the target vector (y)
-    X = df[['temperature', 'humidity']]
-    y = df['anomaly_label']
+    # Trees split on float32 internally, so hand them float32 directly
+    X = np.column_stack((temps, hums)).astype(np.float32)
+    y = historical_data['anomaly_label'].astype(np.int8)
+
+    # Rows stored before the thresholds were set were never labelled; report
+    # them rather than relabel, the stored labels stay the training target
+    if thresholds:
+        temp_threshold, humidity_threshold = thresholds
+        unlabelled = np.count_nonzero(((temps > temp_threshold) | (hums > humidity_threshold)) & (y == 0))
+        if unlabelled:
+            logger.warning("%d of %d training rows exceed the thresholds but are labelled normal", unlabelled, len(y))
     
-    # Train a RandomForestClassifier model
-    model = RandomForestClassifier(n_estimators=100, random_state=42)
+    # Train a RandomForestClassifier model; two features need far fewer and
+    # shallower trees than the defaults. One core by default, so training on
+    # demand never takes the CPU away from the API process it runs in.
+    model = RandomForestClassifier(n_estimators=16, max_depth=6, random_state=42, n_jobs=n_jobs)
     model.fit(X, y)
     
     return model  # Return the trained model object
 
-def predict_anomalies(model, data):
-    X = [[data.temperature, data.humidity]]
-    return model.predict(X)[0] == 1  # 1 indicates an anomaly with RandomForestClassifier
+def to_onnx(model):
+    # Compile a fitted estimator over [temperature, humidity] rows to ONNX bytes
+    onnx_model = convert_sklearn(model, initial_types=[('X', FloatTensorType([None, 2]))])
+    return onnx_model.SerializeToString()
+
+class OnnxModel:
+    # ONNX Runtime session behind the sklearn predict() interface used by analyze()
+    def __init__(self, path):
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.label_name = self.session.get_outputs()[0].name
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return self.session.run([self.label_name], {self.input_name: X})[0]
@@ -5,5 +5,6 @@ logger = get_logger()
 
 def monitor(data):
     # Store the incoming data into the Knowledge component
-    update_knowledge(data)
-    print(f"Data monitored and stored: {data}")
+    anomaly_label = update_knowledge(data)
+    logger.info("Data monitored and stored: %s", data)
+    return anomaly_label
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from app.knowledge import get_all_node_ids, get_historical_columns, get_thresholds, store_ml_model
+from app.ml_model import train_ml_model
+from app.logger import get_logger
+
+logger = get_logger()
+
+def retrain_node(node_id):
+    # Runs in a worker process, which opens its own SQLite connection on first use
+    historical_data = get_historical_columns(node_id)
+    if not len(historical_data['id']):
+        return False
+    # Single-threaded training, the pool already spreads nodes across cores
+    model = train_ml_model(historical_data, get_thresholds(node_id))
+    store_ml_model(node_id, model)
+    return True
+
+def retrain_all_nodes():
+    node_ids = get_all_node_ids()
+    if not node_ids:
+        return
+    # Leave one core to the API process. Workers are spawned rather than forked
+    # so they never inherit the parent's SQLite connections or threads.
+    max_workers = min(len(node_ids), max(1, (os.cpu_count() or 2) - 1))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {node_id: executor.submit(retrain_node, node_id) for node_id in node_ids}
+        for node_id, future in futures.items():
+            try:
+                if future.result():
+                    logger.info("Model retrained for node %s", node_id)
+            except Exception as e:
+                logger.error("Error retraining model for node %s: %s", node_id, e)